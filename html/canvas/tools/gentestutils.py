@@ -35,7 +35,9 @@
 from __future__ import print_function
 
 import re
-import codecs
+import functools
+import io
+import itertools
 import time
 import os
 import shutil
@@ -50,8 +52,72 @@ except ImportError:
 
 try:
     import syck as yaml # compatible and lots faster
+    _yaml_load = yaml.load
 except ImportError:
     import yaml
+    if hasattr(yaml, 'CSafeLoader'):
+        _yaml_load = functools.partial(yaml.load, Loader=yaml.CSafeLoader)
+    else:
+        print("WARNING: PyYAML was built without libyaml, falling back to the (much slower) pure-Python loader", file=sys.stderr)
+        _yaml_load = functools.partial(yaml.load, Loader=yaml.SafeLoader)
+
+def _load_yaml_file(filename):
+    # Let the loader read and decode the file itself
+    with open(filename, 'rb') as f:
+        return _yaml_load(f)
+
+_RE_NONFINITE = re.compile(r'@nonfinite ([^(]+)\(([^)]+)\)(.*)')
+_RE_NONFINITE_ARG = re.compile('<(.*)>')
+_RE_ASSERT_PIXEL = re.compile(r'@assert pixel (\d+,\d+) == (\d+,\d+,\d+,\d+);')
+_RE_ASSERT_PIXEL_APPROX = re.compile(r'@assert pixel (\d+,\d+) ==~ (\d+,\d+,\d+,\d+);')
+_RE_ASSERT_PIXEL_APPROX_TOL = re.compile(r'@assert pixel (\d+,\d+) ==~ (\d+,\d+,\d+,\d+) \+/- (\d+);')
+_RE_ASSERT_THROWS_DOM = re.compile(r'@assert throws (\S+_ERR) (.*);')
+_RE_ASSERT_THROWS_JS = re.compile(r'@assert throws (\S+Error) (.*);')
+_RE_ASSERT_SAME = re.compile(r'@assert (.*) === (.*);')
+_RE_ASSERT_DIFFERENT = re.compile(r'@assert (.*) !== (.*);')
+_RE_ASSERT_REGEXP = re.compile(r'@assert (.*) =~ (.*);')
+_RE_ASSERT = re.compile(r'@assert (.*);')
+_RE_MOZ_TODO = re.compile(r' @moz-todo')
+_RE_MOZ_UNIVERSAL_BROWSER_READ = re.compile(r'@moz-UniversalBrowserRead;')
+_RE_ASSERT_PIXEL_TRANSPARENT = re.compile(r'@assert pixel .* 0,0,0,0;')
+_RE_EXPECTED_SIZE = re.compile(r'^size (\d+) (\d+)')
+_RE_JS_ESCAPE = re.compile(r'(\\)|(")|\[(\w+)\]')
+
+# All the '@' macros, combined into a single pattern so that test code is
+# scanned once. Alternatives are tried in this order at each position, which
+# matches the order the macros used to be expanded in.
+_MACROS = [
+    ('nonfinite', _RE_NONFINITE), # must come before '@assert throws'
+    ('assert_pixel', _RE_ASSERT_PIXEL),
+    ('assert_pixel_approx', _RE_ASSERT_PIXEL_APPROX),
+    ('assert_pixel_approx_tol', _RE_ASSERT_PIXEL_APPROX_TOL),
+    ('assert_throws_dom', _RE_ASSERT_THROWS_DOM),
+    ('assert_throws_js', _RE_ASSERT_THROWS_JS),
+    ('assert_same', _RE_ASSERT_SAME),
+    ('assert_different', _RE_ASSERT_DIFFERENT),
+    ('assert_regexp', _RE_ASSERT_REGEXP),
+    ('assert', _RE_ASSERT),
+    ('moz_todo', _RE_MOZ_TODO),
+    ('moz_universal_browser_read', _RE_MOZ_UNIVERSAL_BROWSER_READ),
+]
+_RE_MACRO = re.compile('|'.join('(?P<%s>%s)' % (name, regex.pattern) for (name, regex) in _MACROS))
+# Position of each macro's own groups within _RE_MACRO's match.groups()
+_MACRO_GROUPS = dict((name, slice(_RE_MACRO.groupindex[name], _RE_MACRO.groupindex[name] + regex.groups))
+                     for (name, regex) in _MACROS)
+
+# 'expected' values that refer to one of the shared 100x50 reference images
+_STOCK_EXPECTED_IMAGES = {
+    'green': '/images/green-100x50.png',
+    'clear': '/images/clear-100x50.png',
+}
+
+_EXPECTATION_HTML = ('<p class="output expectedtext">Expected output:'
+    '<p><img src="%s" class="output expected" id="expected" alt="">')
+
+# PNG data already rendered for each 'expected' Pycairo source. Tests often
+# share the same expected drawing code, and the result only needs to be drawn
+# once.
+_expected_images = {}
 
 def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOFFSCREENCANVAS):
 
@@ -63,10 +129,15 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
     def simpleEscapeJS(str):
         return str.replace('\\', '\\\\').replace('"', '\\"')
 
+    def escapeJSMatch(m):
+        if m.group(1):
+            return '\\\\'
+        if m.group(2):
+            return '\\"'
+        return '[\\""+(%s)+"\\"]' % m.group(3) # kind of an ugly hack, for nicer failure-message output
+
     def escapeJS(str):
-        str = simpleEscapeJS(str)
-        str = re.sub(r'\[(\w+)\]', r'[\\""+(\1)+"\\"]', str) # kind of an ugly hack, for nicer failure-message output
-        return str
+        return _RE_JS_ESCAPE.sub(escapeJSMatch, str)
 
     def escapeHTML(str):
         return str.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
@@ -91,7 +162,7 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
         # 'invalid' is Infinity/-Infinity/NaN)
         args = []
         for arg in argstr.split(', '):
-            a = re.match('<(.*)>', arg).group(1)
+            a = _RE_NONFINITE_ARG.match(arg).group(1)
             args.append(a.split(' '))
         calls = []
         # Start with the valid argument list
@@ -105,15 +176,23 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
         # For all combinations of >= 2 arguments, try setting them to their
         # first invalid values. (Don't do all invalid values, because the
         # number of combinations explodes.)
-        def f(c, start, depth):
-            for i in range(start, len(args)):
-                if len(args[i]) > 1:
-                    a = args[i][1]
-                    c2 = c[:]
-                    c2[i] = a
-                    if depth > 0: calls.append(c2)
-                    f(c2, i+1, depth+1)
-        f(call, 0, 0)
+        # The combinations are walked in lexicographic order of argument
+        # index, using 'chosen' as an explicit stack of indexes into
+        # 'invalid_args'.
+        invalid_args = [ i for i in range(len(args)) if len(args[i]) > 1 ]
+        chosen = [0] if invalid_args else []
+        while chosen:
+            if len(chosen) >= 2:
+                c = call[:]
+                for k in chosen:
+                    c[invalid_args[k]] = args[invalid_args[k]][1]
+                calls.append(c)
+            if chosen[-1] + 1 < len(invalid_args):
+                chosen.append(chosen[-1] + 1)
+            else:
+                chosen.pop()
+                if chosen:
+                    chosen[-1] += 1
 
         return '\n'.join('%s(%s)%s' % (method, ', '.join(c), tail) for c in calls)
 
@@ -123,12 +202,14 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
         doctest.testmod()
         sys.exit()
 
-    templates = yaml.load(open(TEMPLATEFILE, "r").read())
-    name_mapping = yaml.load(open(NAME2DIRFILE, "r").read())
+    templates = _load_yaml_file(TEMPLATEFILE)
+    test_template = templates['w3c']
+    worker_template = templates['w3cworker'] if ISOFFSCREENCANVAS else None
+    name_mapping = _load_yaml_file(NAME2DIRFILE)
 
     SPECFILE = 'spec.yaml'
     spec_assertions = []
-    for s in yaml.load(open(SPECFILE, "r").read())['assertions']:
+    for s in _load_yaml_file(SPECFILE)['assertions']:
         if 'meta' in s:
             eval(compile(s['meta'], '<meta spec assertion>', 'exec'), {}, {'assertions':spec_assertions})
         else:
@@ -141,7 +222,7 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
     TESTSFILES = [
         os.path.join(test_yaml_directory, f) for f in os.listdir(test_yaml_directory)
         if f.endswith(".yaml")]
-    for t in sum([ yaml.load(open(f, "r").read()) for f in TESTSFILES], []):
+    for t in itertools.chain.from_iterable(_load_yaml_file(f) for f in TESTSFILES):
         if 'DISABLED' in t:
             continue
         if 'meta' in t:
@@ -153,17 +234,16 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
     category_contents_direct = {}
     category_contents_all = {}
 
-    spec_ids = {}
-    for t in spec_assertions: spec_ids[t['id']] = True
+    spec_ids = set(t['id'] for t in spec_assertions)
     spec_refs = {}
 
-    def backref_html(name):
+    def backref_html(name_parts):
         backrefs = []
         c = ''
-        for p in name.split('.')[:-1]:
+        for p in name_parts[:-1]:
             c += '.'+p
             backrefs.append('<a href="index%s.html">%s</a>.' % (c, p))
-        backrefs.append(name.split('.')[-1])
+        backrefs.append(name_parts[-1])
         return ''.join(backrefs)
 
     def make_flat_image(filename, w, h, r,g,b,a):
@@ -185,11 +265,14 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
         try: os.mkdir(d)
         except: pass # ignore if it already exists
 
-    used_images = {}
+    used_images = set()
+
+    # Longest prefixes first, so the most specific mapping wins
+    name_mapping_prefixes = sorted(name_mapping.keys(), key=len, reverse=True)
 
     def map_name(name):
         mapped_name = None
-        for mn in sorted(name_mapping.keys(), key=len, reverse=True):
+        for mn in name_mapping_prefixes:
             if name.startswith(mn):
                 mapped_name = "%s/%s" % (name_mapping[mn], name)
                 break
@@ -199,75 +282,48 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
             mapped_name += "-manual"
         return mapped_name
 
-    def expand_test_code(code):
-        code = re.sub(r'@nonfinite ([^(]+)\(([^)]+)\)(.*)', lambda m: expand_nonfinite(m.group(1), m.group(2), m.group(3)), code) # must come before '@assert throws'
-
-        if ISOFFSCREENCANVAS:
-            code = re.sub(r'@assert pixel (\d+,\d+) == (\d+,\d+,\d+,\d+);',
-                    r'_assertPixel(offscreenCanvas, \1, \2, "\1", "\2");',
-                    code)
-        else:
-            code = re.sub(r'@assert pixel (\d+,\d+) == (\d+,\d+,\d+,\d+);',
-                    r'_assertPixel(canvas, \1, \2, "\1", "\2");',
-                    code)
-
-        if ISOFFSCREENCANVAS:
-            code = re.sub(r'@assert pixel (\d+,\d+) ==~ (\d+,\d+,\d+,\d+);',
-                    r'_assertPixelApprox(offscreenCanvas, \1, \2, "\1", "\2", 2);',
-                    code)
-        else:
-            code = re.sub(r'@assert pixel (\d+,\d+) ==~ (\d+,\d+,\d+,\d+);',
-                    r'_assertPixelApprox(canvas, \1, \2, "\1", "\2", 2);',
-                    code)
-
-        if ISOFFSCREENCANVAS:
-            code = re.sub(r'@assert pixel (\d+,\d+) ==~ (\d+,\d+,\d+,\d+) \+/- (\d+);',
-                    r'_assertPixelApprox(offscreenCanvas, \1, \2, "\1", "\2", \3);',
-                    code)
-        else:
-            code = re.sub(r'@assert pixel (\d+,\d+) ==~ (\d+,\d+,\d+,\d+) \+/- (\d+);',
-                    r'_assertPixelApprox(canvas, \1, \2, "\1", "\2", \3);',
-                    code)
-
-        code = re.sub(r'@assert throws (\S+_ERR) (.*);',
-                r'assert_throws_dom("\1", function() { \2; });',
-                code)
-
-        code = re.sub(r'@assert throws (\S+Error) (.*);',
-                r'assert_throws_js(\1, function() { \2; });',
-                code)
+    canvas_name = 'offscreenCanvas' if ISOFFSCREENCANVAS else 'canvas'
+
+    macro_expansions = {
+        # The expanded calls are usually '@assert throws' macros themselves
+        'nonfinite': lambda g: _RE_MACRO.sub(expand_macro, expand_nonfinite(g[0], g[1], g[2])),
+        'assert_pixel': lambda g: '_assertPixel(%s, %s, %s, "%s", "%s");'
+            % (canvas_name, g[0], g[1], g[0], g[1]),
+        'assert_pixel_approx': lambda g: '_assertPixelApprox(%s, %s, %s, "%s", "%s", 2);'
+            % (canvas_name, g[0], g[1], g[0], g[1]),
+        'assert_pixel_approx_tol': lambda g: '_assertPixelApprox(%s, %s, %s, "%s", "%s", %s);'
+            % (canvas_name, g[0], g[1], g[0], g[1], g[2]),
+        'assert_throws_dom': lambda g: 'assert_throws_dom("%s", function() { %s; });'
+            % (g[0], g[1]),
+        'assert_throws_js': lambda g: 'assert_throws_js(%s, function() { %s; });'
+            % (g[0], g[1]),
+        'assert_same': lambda g: '_assertSame(%s, %s, "%s", "%s");'
+            % (g[0], g[1], escapeJS(g[0]), escapeJS(g[1])),
+        'assert_different': lambda g: '_assertDifferent(%s, %s, "%s", "%s");'
+            % (g[0], g[1], escapeJS(g[0]), escapeJS(g[1])),
+        'assert_regexp': lambda g: 'assert_regexp_match(%s, %s);'
+            % (g[0], g[1]),
+        'assert': lambda g: '_assert(%s, "%s");'
+            % (g[0], escapeJS(g[0])),
+        'moz_todo': lambda g: '',
+        'moz_universal_browser_read': lambda g: '',
+    }
+
+    def expand_macro(m):
+        return macro_expansions[m.lastgroup](m.groups()[_MACRO_GROUPS[m.lastgroup]])
 
-        code = re.sub(r'@assert (.*) === (.*);',
-                lambda m: '_assertSame(%s, %s, "%s", "%s");'
-                    % (m.group(1), m.group(2), escapeJS(m.group(1)), escapeJS(m.group(2)))
-                , code)
-
-        code = re.sub(r'@assert (.*) !== (.*);',
-                lambda m: '_assertDifferent(%s, %s, "%s", "%s");'
-                    % (m.group(1), m.group(2), escapeJS(m.group(1)), escapeJS(m.group(2)))
-                , code)
-
-        code = re.sub(r'@assert (.*) =~ (.*);',
-                lambda m: 'assert_regexp_match(%s, %s);'
-                    % (m.group(1), m.group(2))
-                , code)
-
-        code = re.sub(r'@assert (.*);',
-                lambda m: '_assert(%s, "%s");'
-                    % (m.group(1), escapeJS(m.group(1)))
-                , code)
-
-        code = re.sub(r' @moz-todo', '', code)
+    def expand_test_code(code):
+        # Every macro starts with '@', so code without one needs no expansion
+        if '@' not in code:
+            return code
 
-        code = re.sub(r'@moz-UniversalBrowserRead;',
-                ""
-                , code)
+        code = _RE_MACRO.sub(expand_macro, code)
 
         assert('@' not in code)
 
         return code
 
-    used_tests = {}
+    used_tests = set()
     for i in range(len(tests)):
         test = tests[i]
 
@@ -276,7 +332,7 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
 
         if name in used_tests:
             print("Test %s is defined twice" % name)
-        used_tests[name] = 1
+        used_tests.add(name)
 
         mapped_name = map_name(name)
         if not mapped_name:
@@ -287,51 +343,56 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
 
 
         cat_total = ''
-        for cat_part in [''] + name.split('.')[:-1]:
+        name_parts = name.split('.')
+        for cat_part in [''] + name_parts[:-1]:
             cat_total += cat_part+'.'
-            if not cat_total in category_names: category_names.append(cat_total)
+            # category_contents_all gets a key for exactly the categories in
+            # category_names, and is much cheaper to search than the list
+            if not cat_total in category_contents_all: category_names.append(cat_total)
             category_contents_all.setdefault(cat_total, []).append(name)
         category_contents_direct.setdefault(cat_total, []).append(name)
 
-        for ref in test.get('testing', []):
+        testing = test.get('testing', [])
+        for ref in testing:
             if ref not in spec_ids:
                 print("Test %s uses nonexistent spec point %s" % (name, ref))
             spec_refs.setdefault(ref, []).append(name)
 
-        if not test.get('testing', []):
+        if not testing:
             print("Test %s doesn't refer to any spec points" % name)
 
-        if test.get('expected', '') == 'green' and re.search(r'@assert pixel .* 0,0,0,0;', test['code']):
+        expected = test.get('expected')
+        if expected == 'green' and _RE_ASSERT_PIXEL_TRANSPARENT.search(test['code']):
             print("Probable incorrect pixel test in %s" % name)
 
         code = expand_test_code(test['code'])
 
         expectation_html = ''
-        if 'expected' in test and test['expected'] is not None:
-            expected = test['expected']
-            expected_img = None
-            if expected == 'green':
-                expected_img = "/images/green-100x50.png"
-            elif expected == 'clear':
-                expected_img = "/images/clear-100x50.png"
-            else:
+        if expected is not None:
+            expected_img = _STOCK_EXPECTED_IMAGES.get(expected)
+            if expected_img is None:
                 if ';' in expected:
                     print("Found semicolon in %s" % name)
-                expected = re.sub(r'^size (\d+) (\d+)',
-                    r'surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, \1, \2)\ncr = cairo.Context(surface)',
-                                  expected)
-
                 if mapped_name.endswith("-manual"):
                     png_name = mapped_name[:-len("-manual")]
                 else:
                     png_name = mapped_name
-                expected += "\nsurface.write_to_png('%s/%s.png')\n" % (IMAGEOUTPUTDIR, png_name)
-                eval(compile(expected, '<test %s>' % test['name'], 'exec'), {}, {'cairo':cairo})
+                png_path = '%s/%s.png' % (IMAGEOUTPUTDIR, png_name)
+
+                if expected not in _expected_images:
+                    source = _RE_EXPECTED_SIZE.sub(
+                        r'surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, \1, \2)\ncr = cairo.Context(surface)',
+                        expected)
+                    source += "\nsurface.write_to_png(_output)\n"
+                    png = io.BytesIO()
+                    eval(compile(source, '<test %s>' % test['name'], 'exec'), {}, {'cairo':cairo, '_output':png})
+                    _expected_images[expected] = png.getvalue()
+                with open(png_path, 'wb') as f:
+                    f.write(_expected_images[expected])
                 expected_img = "%s.png" % name
 
             if expected_img:
-                expectation_html = ('<p class="output expectedtext">Expected output:' +
-                    '<p><img src="%s" class="output expected" id="expected" alt="">' % (expected_img))
+                expectation_html = _EXPECTATION_HTML % expected_img
 
         canvas = test.get('canvas', 'width="100" height="50"')
 
@@ -340,43 +401,40 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
 
         name_wrapped = name.replace('.', '.&#8203;')
 
-        refs = ''.join('<li><a href="%s/annotated-spec.html#testrefs.%s">%s</a>\n' % (SPECOUTPUTPATH, n,n) for n in test.get('testing', []))
+        refs = ''.join('<li><a href="%s/annotated-spec.html#testrefs.%s">%s</a>\n' % (SPECOUTPUTPATH, n,n) for n in testing)
 
         notes = '<p class="notes">%s' % test['notes'] if 'notes' in test else ''
 
         timeout = '\n<meta name="timeout" content="%s">' % test['timeout'] if 'timeout' in test else ''
 
-        scripts = ''
-        for s in test.get('scripts', []):
-            scripts += '<script src="%s"></script>\n' % (s)
+        scripts = ''.join('<script src="%s"></script>\n' % (s) for s in test.get('scripts', []))
 
         variants = test.get('script-variants', {})
         script_variants = [(v, '<script src="%s"></script>\n' % (s)) for (v, s) in variants.items()]
         if not script_variants:
             script_variants = [('', '')]
 
-        images = ''
-        for i in test.get('images', []):
-            id = i.split('/')[-1]
-            if '/' not in i:
-                used_images[i] = 1
-                i = '../images/%s' % i
-            images += '<img src="%s" id="%s" class="resource">\n' % (i,id)
-        for i in test.get('svgimages', []):
-            id = i.split('/')[-1]
-            if '/' not in i:
-                used_images[i] = 1
-                i = '../images/%s' % i
-            images += '<svg><image xlink:href="%s" id="%s" class="resource"></svg>\n' % (i,id)
-        images = images.replace("../images/", "/images/")
-
-        fonts = ''
+        images = []
+        image_resources = [
+            ('<img src="%s" id="%s" class="resource">\n', test.get('images', [])),
+            ('<svg><image xlink:href="%s" id="%s" class="resource"></svg>\n', test.get('svgimages', [])),
+        ]
+        for (image_html, image_list) in image_resources:
+            for i in image_list:
+                id = i.split('/')[-1]
+                if '/' not in i:
+                    used_images.add(i)
+                    i = '/images/%s' % i
+                else:
+                    i = i.replace("../images/", "/images/")
+                images.append(image_html % (i,id))
+        images = ''.join(images)
+
+        fonts = ''.join('@font-face {\n  font-family: %s;\n  src: url("/fonts/%s.ttf");\n}\n' % (i, i) for i in test.get('fonts', []))
+        # Browsers require the font to actually be used in the page
         fonthack = ''
-        for i in test.get('fonts', []):
-            fonts += '@font-face {\n  font-family: %s;\n  src: url("/fonts/%s.ttf");\n}\n' % (i, i)
-            # Browsers require the font to actually be used in the page
-            if test.get('fonthack', 1):
-                fonthack += '<span style="font-family: %s; position: absolute; visibility: hidden">A</span>\n' % i
+        if test.get('fonthack', 1):
+            fonthack = ''.join('<span style="font-family: %s; position: absolute; visibility: hidden">A</span>\n' % i for i in test.get('fonts', []))
         if fonts:
             fonts = '<style>\n%s</style>\n' % fonts
 
@@ -385,26 +443,30 @@ def genTestUtils(TESTOUTPUTDIR, IMAGEOUTPUTDIR, TEMPLATEFILE, NAME2DIRFILE, ISOF
         desc = test.get('desc', '')
         escaped_desc = simpleEscapeJS(desc)
 
+        # Only 'name' and 'scripts' differ between script variants; they are
+        # overwritten in place below for each one.
+        template_params = {
+            'name_wrapped':name_wrapped, 'backrefs':backref_html(name_parts),
+            'mapped_name':mapped_name,
+            'desc':desc, 'escaped_desc':escaped_desc,
+            'prev':prev, 'next':next, 'refs':refs, 'notes':notes, 'images':images,
+            'fonts':fonts, 'fonthack':fonthack, 'timeout': timeout,
+            'canvas':canvas, 'expected':expectation_html, 'code':code,
+            'fallback':fallback
+        }
+
+        output_path = '%s/%s' % (TESTOUTPUTDIR, mapped_name)
         for (variant, extra_script) in script_variants:
             name_variant = '' if not variant else '.' + variant
 
-            template_params = {
-                'name':name + name_variant,
-                'name_wrapped':name_wrapped, 'backrefs':backref_html(name),
-                'mapped_name':mapped_name,
-                'desc':desc, 'escaped_desc':escaped_desc,
-                'prev':prev, 'next':next, 'refs':refs, 'notes':notes, 'images':images,
-                'fonts':fonts, 'fonthack':fonthack, 'timeout': timeout,
-                'canvas':canvas, 'expected':expectation_html, 'code':code,
-                'scripts':scripts + extra_script,
-                'fallback':fallback
-            }
-
-            f = codecs.open('%s/%s%s.html' % (TESTOUTPUTDIR, mapped_name, name_variant), 'w', 'utf-8')
-            f.write(templates['w3c'] % template_params)
+            template_params['name'] = name + name_variant
+            template_params['scripts'] = scripts + extra_script
+
+            with open('%s%s.html' % (output_path, name_variant), 'wb') as f:
+                f.write((test_template % template_params).encode('utf-8'))
             if ISOFFSCREENCANVAS:
-                f = codecs.open('%s/%s%s.worker.js' % (TESTOUTPUTDIR, mapped_name, name_variant), 'w', 'utf-8')
-                f.write(templates['w3cworker'] % template_params)
+                with open('%s%s.worker.js' % (output_path, name_variant), 'wb') as f:
+                    f.write((worker_template % template_params).encode('utf-8'))
 
     print()
 